@@ -1,17 +1,44 @@
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
 import redis.asyncio as aioredis
 from fastapi import FastAPI
 
+from app.engine import close_engine_pool, start_engine_pool
+
 REDIS_URL = "redis://localhost"  
+REDIS_MAX_CONNECTIONS = 64
+# How long a command waits for a free pooled connection before erroring.
+REDIS_POOL_TIMEOUT_S = 5
 
-def bind_redis(app: FastAPI) -> None:
-    """Attach a Redis pool to app.state.redis on startup, close on shutdown."""
+@asynccontextmanager
+async def redis_lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """Attach a Redis pool to app.state.redis for the app's lifetime, close it on exit."""
+    # Raw bytes in and out: cache values are orjson-encoded, so decoding
+    # replies to str would only be re-encoded on the way into orjson.
+    # redis-py picks the hiredis C reply parser automatically when it is installed.
+    # A blocking pool makes commands queue for a connection once all of them are
+    # in use; the default pool raises "Too many connections" instead, which
+    # /eval would treat as a cache miss and answer with a Stockfish search.
+    pool = aioredis.BlockingConnectionPool.from_url(
+        REDIS_URL,
+        decode_responses=False,
+        max_connections=REDIS_MAX_CONNECTIONS,
+        timeout=REDIS_POOL_TIMEOUT_S,
+        health_check_interval=30,
+    )
+    app.state.redis = aioredis.Redis.from_pool(pool) # Owns the pool; aclose() disconnects it
+    try:
+        yield
+    finally:
+        await app.state.redis.aclose()
 
-    @app.on_event("startup")
-    async def _open() -> None:
-        app.state.redis = aioredis.from_url(
-            REDIS_URL, encoding="utf-8", decode_responses=True
-        )
 
-    @app.on_event("shutdown")
-    async def _close() -> None:
-        await app.state.redis.close()
+@asynccontextmanager
+async def engine_pool_lifespan() -> AsyncIterator[None]:
+    """Warm the Stockfish engine pool before serving, quit every engine on exit."""
+    await start_engine_pool()
+    try:
+        yield
+    finally:
+        await close_engine_pool()
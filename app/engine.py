@@ -1,8 +1,10 @@
 import asyncio
 import logging
-from functools import lru_cache, partial # Import partial
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Tuple
+from typing import Any, AsyncIterator, Callable, Dict, List, Tuple, TypeVar
 
 import chess
 import chess.engine
@@ -28,20 +30,42 @@ if not STOCKFISH_PATH.exists():
         logger.error("Please adjust STOCKFISH_PATH in engine.py or ensure Stockfish is installed and accessible.")
         # The application will likely fail later if Stockfish isn't found, which is appropriate.
 
-# --- singleton engine process ----------------------------------------
-@lru_cache
-def _engine() -> chess.engine.SimpleEngine:
-    """Start Stockfish exactly once per interpreter."""
+# --- engine options ---------------------------------------------------
+# Leave one core for the event loop / Redis client and split the rest across
+# the pool: many engines x 1 thread favours QPS, few engines x many threads
+# favours single-query latency. Hash is in MB, per engine.
+_SF_CORES = max(1, (os.cpu_count() or 1) - 1)
+SF_POOL_SIZE = max(1, int(os.environ.get("SF_POOL_SIZE", 2)))
+SF_THREADS = max(1, _SF_CORES // SF_POOL_SIZE)
+SF_HASH_MB = int(os.environ.get("SF_HASH_MB", 512))
+# Directory of Syzygy endgame tablebases (unset = no tablebase probing).
+SYZYGY_PATH = os.environ.get("SYZYGY_PATH", "")
+# How long a request may wait for a free engine before reporting ENGINE_UNAVAILABLE
+# (unset or 0 = wait as long as it takes). There is no safe finite default:
+# depth-only searches (no time_ms) have no time bound, so a valid request queued
+# behind SF_POOL_SIZE deep searches can legitimately wait for minutes. A pool
+# with no live engines left fails fast in acquire() regardless.
+SF_ACQUIRE_TIMEOUT_S = float(os.environ.get("SF_ACQUIRE_TIMEOUT_S", 0)) or None
+
+_T = TypeVar("_T")
+
+# --- engine processes -------------------------------------------------
+def _start_engine() -> chess.engine.SimpleEngine:
+    """Launch and configure one Stockfish process (blocking)."""
     logger.info(f"Attempting to start Stockfish from: {STOCKFISH_PATH}")
     try:
         engine = chess.engine.SimpleEngine.popen_uci(str(STOCKFISH_PATH))
         logger.info("Stockfish engine started successfully.")
-        # Example: Configure engine options
-        # try:
-        #     engine.configure({"Threads": 2, "Hash": 128})
-        #     logger.info("Successfully configured Stockfish options (Threads: 2, Hash: 128).")
-        # except chess.engine.EngineError as e:
-        #     logger.warning(f"Could not configure Stockfish options: {e}")
+        # MultiPV is managed by python-chess per analyse() call and stays at 1.
+        # There is no GUI lag to budget for, so Move Overhead is 0.
+        options = {"Threads": SF_THREADS, "Hash": SF_HASH_MB, "UCI_AnalyseMode": True, "Move Overhead": 0}
+        if SYZYGY_PATH:
+            options.update({"SyzygyPath": SYZYGY_PATH, "SyzygyProbeDepth": 1})
+        try:
+            engine.configure(options)
+            logger.info(f"Configured Stockfish options: {options}")
+        except chess.engine.EngineError as e:
+            logger.warning(f"Could not configure Stockfish options: {e}")
         return engine
     except FileNotFoundError: # Specific exception for file not found
         logger.critical(f"Stockfish binary not found at path: {STOCKFISH_PATH}. The application cannot function without it.")
@@ -51,50 +75,200 @@ def _engine() -> chess.engine.SimpleEngine:
         logger.critical("Ensure Stockfish is installed correctly and STOCKFISH_PATH is valid.")
         raise # Re-raise
 
+
+class _EnginePool:
+    """
+    Fixed-size pool of Stockfish processes handed out through an asyncio.LifoQueue.
+    Waiters are served FIFO, so a burst of requests queues here instead of
+    piling up on a single engine's mutex. Idle engines are handed out LIFO:
+    the most recently used engine, whose hash table holds the neighbouring
+    positions of the game being browsed, serves the next request. python-chess
+    only sends `ucinewgame` when the `game` argument changes, and we never pass
+    one, so that hash survives from one position to the next. Blocking engine calls run on a
+    dedicated executor with one thread per engine, so they never compete with
+    other users of the default executor.
+    """
+
+    def __init__(self) -> None:
+        self._queue: asyncio.LifoQueue[chess.engine.SimpleEngine] | None = None
+        self._engines: List[chess.engine.SimpleEngine] = []
+        self._executor: ThreadPoolExecutor | None = None
+        self._restarts: set[asyncio.Task] = set() # Strong refs for release_after()'s replacements
+
+    async def start(self, size: int = SF_POOL_SIZE) -> None:
+        if self._queue is not None:
+            return
+        queue: asyncio.LifoQueue[chess.engine.SimpleEngine] = asyncio.LifoQueue(maxsize=size)
+        self._executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="sf")
+        # Launch the processes concurrently; startup costs one spawn, not `size` of them.
+        results = await asyncio.gather(
+            *(asyncio.to_thread(_start_engine) for _ in range(size)), return_exceptions=True
+        )
+        self._engines = [r for r in results if not isinstance(r, BaseException)]
+        errors = [r for r in results if isinstance(r, BaseException)]
+        if errors:
+            await self.close() # Don't leak the engines that did start
+            raise errors[0]
+        for engine in self._engines:
+            queue.put_nowait(engine)
+        self._queue = queue
+        logger.info(f"Engine pool started with {size} Stockfish process(es), {SF_THREADS} thread(s) each.")
+
+    async def acquire(self) -> chess.engine.SimpleEngine:
+        if self._queue is None:
+            raise RuntimeError("Engine pool has not been started.")
+        if not self._engines:
+            raise RuntimeError("Every Stockfish engine in the pool has died and could not be restarted.")
+        try:
+            return await asyncio.wait_for(self._queue.get(), SF_ACQUIRE_TIMEOUT_S)
+        except TimeoutError:
+            raise RuntimeError(f"No Stockfish engine became free within {SF_ACQUIRE_TIMEOUT_S}s.") from None
+
+    async def run(self, fn: Callable[..., _T], *args: Any) -> _T:
+        """Run a blocking call for an acquired engine on the pool's executor."""
+        if self._executor is None:
+            raise RuntimeError("Engine pool has not been started.")
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def release(self, engine: chess.engine.SimpleEngine) -> None:
+        if self._queue is not None:
+            self._queue.put_nowait(engine)
+
+    def release_after(self, engine: chess.engine.SimpleEngine, search: "asyncio.Future[Any]") -> None:
+        """
+        Hand `engine` back once `search`, a run() call using it, settles: released
+        as-is, or replaced if the search found it terminated. Nothing here awaits,
+        so it still happens when the caller is being cancelled.
+        """
+        def _hand_back(done: "asyncio.Future[Any]") -> None:
+            if not done.cancelled() and isinstance(done.exception(), chess.engine.EngineTerminatedError):
+                task = asyncio.ensure_future(self.replace(engine))
+                self._restarts.add(task)
+                task.add_done_callback(self._restarts.discard)
+            else:
+                self.release(engine)
+
+        search.add_done_callback(_hand_back)
+
+    async def replace(self, dead: chess.engine.SimpleEngine) -> None:
+        """
+        Swap a terminated engine for a fresh process and hand that back to the pool.
+        The dead engine stays counted until the restart fails, so acquire() only
+        fails fast once no engine is left at all.
+        """
+        try:
+            # Best effort: release its transport and reap the process
+            await asyncio.to_thread(dead.close)
+        except Exception as e:
+            logger.warning(f"Error closing terminated Stockfish engine: {e}")
+        try:
+            engine = await asyncio.to_thread(_start_engine)
+        except Exception:
+            logger.critical("Could not restart a terminated Stockfish engine; pool is one engine short.")
+            engine = None
+        if dead in self._engines:
+            self._engines.remove(dead)
+        if engine is not None:
+            self._engines.append(engine)
+            self.release(engine)
+
+    async def close(self) -> None:
+        engines, self._engines, self._queue = self._engines, [], None
+        for engine in engines:
+            try:
+                await asyncio.to_thread(engine.quit)
+            except Exception as e:
+                logger.warning(f"Error quitting Stockfish engine: {e}")
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        logger.info(f"Engine pool closed ({len(engines)} engine(s) quit).")
+
+
+_pool = _EnginePool()
+
+
+async def start_engine_pool(size: int = SF_POOL_SIZE) -> None:
+    await _pool.start(size)
+
+
+async def close_engine_pool() -> None:
+    await _pool.close()
+
 # --- public helper ----------------------------------------------------
-async def evaluate_fen(fen: str, depth: int = 18) -> Tuple[int, str]:
+def _limit(depth: int, time_ms: int | None) -> chess.engine.Limit:
+    """Depth cap, plus a wall-clock budget when given; Stockfish stops at whichever comes first."""
+    if time_ms is None:
+        return chess.engine.Limit(depth=depth)
+    return chess.engine.Limit(depth=depth, time=time_ms / 1000)
+
+
+def _is_complete_iteration(info: chess.engine.InfoDict) -> bool:
+    """Whether an info line carries the scored PV of an iterative-deepening step."""
+    # Bound-only lines are fail-high/low re-searches, not a finished iteration
+    return bool(info.get("depth")) and "score" in info and bool(info.get("pv")) and not info.get("lowerbound") and not info.get("upperbound")
+
+
+def _analyse_by_depth(
+    engine: chess.engine.SimpleEngine, board: chess.Board, limit: chess.engine.Limit
+) -> Tuple[List[chess.engine.InfoDict], Dict[int, chess.engine.InfoDict]]:
+    """
+    Run one search (blocking) and return its final MultiPV list, plus the last
+    scored info line of every iterative-deepening step it went through.
     """
-    Analyse a FEN at the given depth.
+    by_depth: Dict[int, chess.engine.InfoDict] = {}
+    # The 'multipv' option tells Stockfish how many lines to calculate. multipv=1 means just the principal variation.
+    with engine.analysis(board, limit, multipv=1) as analysis:
+        for info in analysis:
+            if _is_complete_iteration(info):
+                by_depth[info["depth"]] = info
+        return analysis.multipv, by_depth
+
+
+async def evaluate_fen(
+    fen: str, depth: int = 18, board: chess.Board | None = None, time_ms: int | None = None
+) -> Tuple[int, str]:
+    """
+    Analyse a FEN at the given depth, stopping early once `time_ms` (if given) has elapsed.
+    Pass `board` when the caller has already parsed `fen` to skip a second parse; it is not mutated.
     Returns (centipawn_score_from_white_perspective, SAN_principal_variation_or_error_string).
     """
-    try:
-        board_to_analyze = chess.Board(fen) # Validate FEN early
-    except ValueError as e:
-        logger.error(f"Invalid FEN string received: '{fen}'. Error: {e}")
-        return 0, "ERROR:INVALID_FEN"
+    score, pv, _ = await evaluate_fen_by_depth(fen, depth, board, time_ms)
+    return score, pv
 
-    logger.info(f"Evaluating FEN: {fen} at depth {depth}")
-    logger.info(f"Board to analyze: {'White' if board_to_analyze.turn == chess.WHITE else 'Black'} to move.")
 
-    current_engine: chess.engine.SimpleEngine | None = None
+async def evaluate_fen_by_depth(
+    fen: str, depth: int = 18, board: chess.Board | None = None, time_ms: int | None = None
+) -> Tuple[int, str, Dict[int, Tuple[int, str]]]:
+    """
+    Like evaluate_fen, but also returns the (score, pv) of every shallower depth
+    the same search completed on the way, keyed by depth, so callers can cache
+    them without searching again.
+    """
+    if board is not None:
+        board_to_analyze = board
+    else:
+        try:
+            board_to_analyze = chess.Board(fen) # Validate FEN early
+        except ValueError as e:
+            logger.error(f"Invalid FEN string received: '{fen}'. Error: {e}")
+            return 0, "ERROR:INVALID_FEN", {}
+
+    logger.debug("Evaluating FEN: %s at depth %d (%s to move)", fen, depth, "White" if board_to_analyze.turn == chess.WHITE else "Black")
+
     try:
-        current_engine = _engine()
-    except Exception as e: 
+        current_engine = await _pool.acquire()
+    except Exception as e:
         logger.critical(f"Could not get Stockfish engine instance: {e}", exc_info=True)
-        return 0, "ERROR:ENGINE_UNAVAILABLE" 
-
-    if current_engine is None: # Should be caught by the try-except above, but as a safeguard
-        logger.critical("Stockfish engine is None after attempting to get instance (should have been raised).")
-        return 0, "ERROR:ENGINE_UNAVAILABLE"
+        return 0, "ERROR:ENGINE_UNAVAILABLE", {}
 
-    info: dict = {} 
+    info: dict = {}
+    engine_terminated = False
     try:
-        # Use functools.partial to correctly pass keyword arguments with asyncio.to_thread
-        # The 'multipv' option tells Stockfish how many lines to calculate. multipv=1 means just the principal variation.
-        analyse_with_options = partial(current_engine.analyse, multipv=1) 
-
-        if hasattr(asyncio, "to_thread"): # For Python 3.9+
-            analysis_result = await asyncio.to_thread(
-                analyse_with_options, board_to_analyze, chess.engine.Limit(depth=depth)
-            )
-        else: # Fallback for older Python versions (e.g., 3.8)
-            loop = asyncio.get_running_loop()
-            # Lambda ensures multipv is passed as a keyword argument in the executor
-            analysis_result = await loop.run_in_executor(
-                None,
-                lambda: current_engine.analyse(board_to_analyze, chess.engine.Limit(depth=depth), multipv=1),
-            )
-        
+        analysis_result, infos_by_depth = await _pool.run(
+            _analyse_by_depth, current_engine, board_to_analyze, _limit(depth, time_ms)
+        )
+
         # Process analysis_result
         if isinstance(analysis_result, list) and len(analysis_result) > 0:
             info = analysis_result[0] # Stockfish with MultiPV > 0 (even 1) returns a list
@@ -102,16 +276,113 @@ async def evaluate_fen(fen: str, depth: int = 18) -> Tuple[int, str]:
              info = analysis_result
         else:
             logger.error(f"Unexpected analysis result format: {type(analysis_result)}. Content: {analysis_result}")
-            return 0, "ERROR:ANALYSIS_FORMAT"
+            return 0, "ERROR:ANALYSIS_FORMAT", {}
 
     except chess.engine.EngineTerminatedError:
-        logger.error("Stockfish engine terminated unexpectedly. Clearing cache.", exc_info=True)
-        _engine.cache_clear() 
-        return 0, "ERROR:ENGINE_TERMINATED"
+        logger.error("Stockfish engine terminated unexpectedly. Restarting it.", exc_info=True)
+        engine_terminated = True
+        return 0, "ERROR:ENGINE_TERMINATED", {}
     except Exception as e: # Catch other exceptions during the analysis call itself
-        logger.error(f"Stockfish analysis failed during .analyse() call: {type(e).__name__} - {e}", exc_info=True)
-        return 0, "ERROR:ANALYSIS_FAILED"
+        logger.error(f"Stockfish analysis failed during .analysis() call: {type(e).__name__} - {e}", exc_info=True)
+        return 0, "ERROR:ANALYSIS_FAILED", {}
+    finally:
+        if engine_terminated:
+            await _pool.replace(current_engine)
+        else:
+            _pool.release(current_engine)
 
+    # The SAN replay for every depth is pure-Python work; keep it off the event loop.
+    # Short CPU-bound jobs, so the default executor rather than the engines' own.
+    return await asyncio.to_thread(_results_from_search, info, infos_by_depth, board_to_analyze, fen, depth)
+
+
+def _results_from_search(
+    info: chess.engine.InfoDict,
+    infos_by_depth: Dict[int, chess.engine.InfoDict],
+    board: chess.Board,
+    fen: str,
+    depth: int,
+) -> Tuple[int, str, Dict[int, Tuple[int, str]]]:
+    """Convert the final and per-depth info lines of one search (blocking)."""
+    # One scratch board for every SAN replay below; stack=False skips copying the move history
+    replay_board = board.copy(stack=False)
+    score, pv_san_str = _result_from_info(info, replay_board, fen, depth)
+
+    # Only depths below the deepest one seen are known to be finished iterations:
+    # a time-limited search can be stopped partway through its last depth.
+    deepest = max(infos_by_depth, default=0)
+    shallower = {
+        d: _result_from_info(d_info, replay_board, fen, d)
+        for d, d_info in infos_by_depth.items()
+        if d < deepest and d < depth
+    }
+    return score, pv_san_str, shallower
+
+
+async def stream_evaluation(
+    fen: str, depth: int, board: chess.Board, time_ms: int | None = None
+) -> AsyncIterator[Tuple[int, int, str]]:
+    """
+    Analyse like evaluate_fen, but yield (depth, score, pv) as soon as Stockfish
+    reports each iterative-deepening step. If the consumer stops iterating
+    (e.g. the client went away), the search is stopped and its engine freed.
+    Failures are yielded as a single (0, 0, "ERROR:...") item.
+    """
+    try:
+        current_engine = await _pool.acquire()
+    except Exception as e:
+        logger.critical(f"Could not get Stockfish engine instance: {e}", exc_info=True)
+        yield 0, 0, "ERROR:ENGINE_UNAVAILABLE"
+        return
+
+    loop = asyncio.get_running_loop()
+    updates: asyncio.Queue[Tuple[int, int, str] | None] = asyncio.Queue()
+    running: List[chess.engine.SimpleAnalysisResult] = []
+    stop_requested = threading.Event()
+
+    def _search() -> None:
+        # The SAN replay runs here too, on the search's own worker thread, so
+        # the event loop only ever receives finished (depth, score, pv) items.
+        replay_board = board.copy(stack=False)
+        with current_engine.analysis(board, _limit(depth, time_ms), multipv=1) as analysis:
+            running.append(analysis)
+            if stop_requested.is_set(): # Consumer left before the search started
+                analysis.stop()
+            for info in analysis:
+                if _is_complete_iteration(info):
+                    score, pv = _result_from_info(info, replay_board, fen, info["depth"])
+                    loop.call_soon_threadsafe(updates.put_nowait, (info["depth"], score, pv))
+
+    search = asyncio.ensure_future(_pool.run(_search))
+    # Runs after every update the thread scheduled, so None is always last
+    search.add_done_callback(lambda _: updates.put_nowait(None))
+    try:
+        while (update := await updates.get()) is not None:
+            yield update
+        try:
+            search.result()
+        except chess.engine.EngineTerminatedError:
+            logger.error("Stockfish engine terminated unexpectedly. Restarting it.", exc_info=True)
+            yield 0, 0, "ERROR:ENGINE_TERMINATED"
+        except Exception as e:
+            logger.error(f"Stockfish streaming analysis failed: {type(e).__name__} - {e}", exc_info=True)
+            yield 0, 0, "ERROR:ANALYSIS_FAILED"
+    finally:
+        # No awaits here: on a client disconnect this runs under cancellation,
+        # and the engine must go back to the pool regardless.
+        if not search.done():
+            stop_requested.set()
+            for analysis in running:
+                analysis.stop()
+        _pool.release_after(current_engine, search)
+
+
+def _result_from_info(info: chess.engine.InfoDict, replay_board: chess.Board, fen: str, depth: int) -> Tuple[int, str]:
+    """
+    Turn one analysis info dict into (white_pov_score, SAN_pv_or_error_string).
+    `replay_board` is a scratch copy of the analysed position with an empty move
+    stack; the PV is replayed on it and popped off again before returning.
+    """
     # Score processing
     score_obj = info.get("score")
     score = 0 
@@ -122,12 +393,12 @@ async def evaluate_fen(fen: str, depth: int = 18) -> Tuple[int, str]:
             mate_in = pov_score.mate()
             if mate_in is not None: # Should not be None if is_mate() is True
                  score = (10000 - abs(mate_in)) if mate_in > 0 else (-10000 + abs(mate_in))
-                 logger.info(f"Score derived from mate: {mate_in} (Raw score: {score})")
+                 logger.debug("Score derived from mate: %d (Raw score: %d)", mate_in, score)
         else: # Not a mate
             cp_score = pov_score.score()
             if cp_score is not None:
                 score = cp_score
-                logger.info(f"Score (White's POV, centipawns): {score}")
+                logger.debug("Score (White's POV, centipawns): %d", score)
             else: # Should not happen if not a mate
                 logger.warning(f"Score is not mate, but centipawn score is None. Score object: {score_obj}")
                 logger.critical(f"Score object present but cp_score is None. Full info for FEN {fen} at depth {depth}: {info}")
@@ -141,7 +412,7 @@ async def evaluate_fen(fen: str, depth: int = 18) -> Tuple[int, str]:
                 if isinstance(mate_val_direct, int): # UCI 'mate' is usually an int
                     pov_mate_val = chess.engine.Mate(mate_val_direct).pov(chess.WHITE).mate()
                     score = (10000 - abs(pov_mate_val)) if pov_mate_val > 0 else (-10000 + abs(pov_mate_val))
-                    logger.info(f"Score derived from direct 'mate' field: {pov_mate_val} (Raw score: {score})")
+                    logger.debug("Score derived from direct 'mate' field: %d (Raw score: %d)", pov_mate_val, score)
                 else:
                     logger.error(f"Direct 'mate' field is not an integer: {mate_val_direct}. Type: {type(mate_val_direct)}")
                     return 0, "ERROR:MATE_FIELD_INVALID_TYPE"
@@ -149,50 +420,45 @@ async def evaluate_fen(fen: str, depth: int = 18) -> Tuple[int, str]:
                 logger.error(f"Error processing direct 'mate' field '{mate_val_direct}': {e_mate}", exc_info=True)
                 return 0, "ERROR:MATE_FIELD_PROCESSING"
         else:
-            logger.info(f"No score or direct mate information found in info object.")
+            logger.warning("No score or direct mate information found in info object.")
             return 0, "ERROR:NO_SCORE_OR_MATE"
 
 
     # PV processing
     pv_moves_from_engine = info.get("pv", [])
-    logger.debug(f"Raw PV from Stockfish (info.get('pv')): {pv_moves_from_engine}") # List of chess.Move objects
-    logger.info(f"Length of raw PV from Stockfish: {len(pv_moves_from_engine)} plies.")
+    logger.debug("Raw PV from Stockfish: %s (%d plies)", pv_moves_from_engine, len(pv_moves_from_engine)) # List of chess.Move objects
 
     if not pv_moves_from_engine:
         logger.warning(f"No PV moves in info (pv_moves_from_engine is empty) for FEN {fen} at depth {depth}. Full info: {info}")
         return score, "ERROR:PV_EMPTY" # Return score, but indicate PV is empty
 
     pv_to_convert = pv_moves_from_engine[:20] # Limit to a maximum of 20 plies for SAN conversion
-    logger.info(f"PV plies to be converted to SAN (up to 20): {len(pv_to_convert)} plies.")
-    logger.debug(f"pv_to_convert (UCI strings): {[m.uci() for m in pv_to_convert]}")
 
     san_parts = []
-    # Use a fresh board instance for SAN conversion to avoid state issues
-    replay_board_for_san = chess.Board(fen) 
-    logger.debug(f"Initial FEN for SAN conversion: {replay_board_for_san.fen()}")
 
-    for i, move_obj in enumerate(pv_to_convert):
-        uci_representation = move_obj.uci()
+    # Not Board.variation_san(): its move numbers ("1. e4 e5") would break the
+    # frontend, which splits the PV on spaces. san_and_push() generates SAN and
+    # applies the move in one step, where san() + push() pushes and pops an extra time.
+    for move_obj in pv_to_convert:
+        if not replay_board.is_legal(move_obj):
+            logger.warning(f"Move '{move_obj.uci()}' is NOT legal on SAN replay board '{replay_board.fen()}'. Stopping SAN conversion for this PV.")
+            san_parts.append(move_obj.uci() + " (illegal on replay)") # Add UCI and stop
+            break
         try:
-            if not replay_board_for_san.is_legal(move_obj):
-                logger.warning(f"Ply {i+1}/{len(pv_to_convert)}: Move '{uci_representation}' is NOT legal on SAN replay_board '{replay_board_for_san.fen()}'. Stopping SAN conversion for this PV.")
-                san_parts.append(uci_representation + " (illegal on replay)") # Add UCI and stop
-                break 
-            
-            san_for_this_move = replay_board_for_san.san(move_obj)
-            san_parts.append(san_for_this_move)
-            replay_board_for_san.push(move_obj) # Apply move for context of next SAN
-        except Exception as e_san: # Catch any other errors during SAN conversion or push
-            logger.error(f"Ply {i+1}/{len(pv_to_convert)}: Error converting '{uci_representation}' to SAN on board '{replay_board_for_san.fen()}': {type(e_san).__name__} - {e_san}. Using UCI as fallback.", exc_info=True)
-            san_parts.append(uci_representation) 
-            # Optionally, break here if one SAN conversion error should truncate the rest of the PV
-            # break 
-    
+            san_parts.append(replay_board.san_and_push(move_obj))
+        except Exception as e_san: # Board state is unreliable after a failed push, so stop here
+            logger.error(f"Error converting '{move_obj.uci()}' to SAN: {type(e_san).__name__} - {e_san}. Using UCI as fallback.", exc_info=True)
+            san_parts.append(move_obj.uci())
+            break
+    while replay_board.move_stack: # Rewind for the next caller instead of copying again
+        replay_board.pop()
+
     pv_san_str = " ".join(san_parts) if san_parts else "ERROR:PV_CONVERSION_EMPTY" # Should not happen if pv_moves_from_engine was not empty
-    logger.info(f"Final SAN PV string: '{pv_san_str}' (Length: {len(san_parts)} plies)")
+    logger.debug("Final SAN PV string: '%s' (Length: %d plies)", pv_san_str, len(san_parts))
 
     return score, pv_san_str
 
+
 # Test block for running engine.py directly
 if __name__ == "__main__":
     # If running this script directly, we *do* want to configure basic logging
@@ -212,6 +478,7 @@ if __name__ == "__main__":
 
     async def run_tests():
         logger.info("Starting engine.py direct test run...")
+        await start_engine_pool()
         test_fen = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1" # Standard starting position
         test_depths = [19, 20, 21, 22, 23, 24, 25] # Depths to test
 
@@ -220,19 +487,9 @@ if __name__ == "__main__":
             s, p = await evaluate_fen(test_fen, depth=depth_to_test)
             pv_ply_count = len(p.split()) if not p.startswith('ERROR:') else 'N/A due to error'
             logger.info(f"Result: Score={s}, PV='{p}' (PV SAN ply count: {pv_ply_count})")
-        
-        # Cleanly close the engine after tests
-        try:
-            engine_instance = _engine()
-            if engine_instance:
-                # Use asyncio.to_thread for quitting if available and in a running loop
-                if hasattr(asyncio, "to_thread") and asyncio.get_running_loop().is_running(): # Check if loop is running
-                     await asyncio.to_thread(engine_instance.quit)
-                else:
-                     engine_instance.quit() # Direct quit if not in a suitable async context
-                logger.info("Stockfish engine quit successfully after tests.")
-        except Exception as e:
-            logger.error(f"Error quitting engine after tests: {e}", exc_info=True)
+
+        # Cleanly close the engines after tests
+        await close_engine_pool()
 
     # Run the async test function
     loop.run_until_complete(run_tests())
@@ -1,17 +1,30 @@
-import json
+import asyncio
 import logging 
+import os
 import sys 
+from contextlib import aclosing, asynccontextmanager
+from functools import partial
 
 import chess
-from fastapi import FastAPI, HTTPException, Query
+import orjson
+from cachetools import TTLCache
+from fastapi import FastAPI, Header, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 
-from app.deps import bind_redis 
-from app.engine import evaluate_fen 
-from app.utils import cache_key 
+from app.deps import engine_pool_lifespan, redis_lifespan
+from app.engine import evaluate_fen_by_depth, stream_evaluation
+from app.utils import cache_key, etag_for, normalize_fen
 
 logger = logging.getLogger(__name__)
 
+# Built once and shared by every handler setup_logging touches.
+_FORMATTER = logging.Formatter(
+    '[%(levelname)s] %(asctime)s %(name)s (%(module)s.%(funcName)s:%(lineno)d): %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+
 # --- Logging Setup Function ---
 def setup_logging():
     root_logger = logging.getLogger()
@@ -22,21 +35,13 @@ def setup_logging():
         if isinstance(handler, logging.StreamHandler) and handler.stream == sys.stdout:
             has_console_handler = True
             handler.setLevel(logging.INFO) 
-            formatter = logging.Formatter(
-                '[%(levelname)s] %(asctime)s %(name)s (%(module)s.%(funcName)s:%(lineno)d): %(message)s',
-                datefmt='%Y-%m-%d %H:%M:%S'
-            )
-            handler.setFormatter(formatter)
+            handler.setFormatter(_FORMATTER)
             break
     
     if not has_console_handler:
         stream_handler = logging.StreamHandler(sys.stdout)
         stream_handler.setLevel(logging.INFO) 
-        formatter = logging.Formatter(
-            '[%(levelname)s] %(asctime)s %(name)s (%(module)s.%(funcName)s:%(lineno)d): %(message)s',
-            datefmt='%Y-%m-%d %H:%M:%S'
-        )
-        stream_handler.setFormatter(formatter)
+        stream_handler.setFormatter(_FORMATTER)
         root_logger.addHandler(stream_handler)
         logger.info("Added a new StreamHandler to the root logger.")
     else:
@@ -45,27 +50,143 @@ def setup_logging():
     logger.info("Logging setup attempt complete. Target level: INFO.")
 # -----------------------------------------
 
-app = FastAPI(title="Explain-that-Move")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    setup_logging()
+    # Engines are spawned here, so the first /eval doesn't pay for process startup.
+    async with redis_lifespan(app), engine_pool_lifespan():
+        logger.info("Application startup complete. Logging should be active with custom setup.")
+        try:
+            from app.engine import logger as engine_logger 
+            engine_logger.info("Test log from engine.py logger during application startup (after setup_logging).")
+        except ImportError:
+            logger.warning("Could not import engine_logger for startup test log.")
+        yield
+
+
+app = FastAPI(title="Explain-that-Move", lifespan=lifespan, default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:5173"], 
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET"], # The API is read-only
+    allow_headers=["Content-Type"],
+    max_age=86400, # Let browsers cache preflights for a day
 )
+app.add_middleware(GZipMiddleware, minimum_size=256)
 
-bind_redis(app)
+# Per-worker L1 cache in front of Redis (the shared L2): hot positions are
+# served from process memory without a network round-trip. Every uvicorn
+# worker holds its own copy (~100 B per entry), so size it per deployment.
+# Entries are the orjson-encoded payloads, exactly as stored in Redis.
+L1_MAXSIZE = int(os.environ.get("L1_MAXSIZE", 10_000))
+L1_TTL_S = int(os.environ.get("L1_TTL_S", 3600))
+_L1: TTLCache = TTLCache(maxsize=L1_MAXSIZE, ttl=L1_TTL_S)
 
+# Engine evaluations currently running, keyed by cache key. Concurrent cache
+# misses for the same (fen, depth) await the first caller's task instead of
+# starting their own Stockfish search.
+_inflight: dict[bytes, asyncio.Task] = {}
 
-@app.on_event("startup")
-async def startup_event():
-    setup_logging() 
-    logger.info("Application startup complete. Logging should be active with custom setup.")
+# Strong references to fire-and-forget cache writes; the event loop only keeps
+# weak ones, so an unreferenced task could be garbage-collected mid-flight.
+_background_writes: set[asyncio.Task] = set()
+
+
+def _parse_board(fen: str) -> chess.Board:
+    """Full FEN validation; only needed once the engine is actually going to run."""
     try:
-        from app.engine import logger as engine_logger 
-        engine_logger.info("Test log from engine.py logger during application startup (after setup_logging).")
-    except ImportError:
-        logger.warning("Could not import engine_logger for startup test log.")
+        return chess.Board(fen)
+    except ValueError as exc:
+        logger.error("Invalid FEN received: %s. Error: %s", fen, exc)
+        raise HTTPException(status_code=400, detail=str(exc))
+
+
+# Response-only fields, spliced in front of the encoded payload's own fields.
+_CACHED = b'{"cached":true,'
+_FRESH = b'{"cached":false,'
+_FRESH_NO_REDIS = b'{"cached":false,"error":"redis_unavailable",'
+
+
+def _eval_response(prefix: bytes, encoded: bytes, etag: str) -> Response:
+    """
+    Serve an encoded payload without decoding it: splice `prefix` into the
+    JSON object rather than round-tripping it through a dict. Clients may
+    revalidate with If-None-Match; engine errors are never client-cached.
+    """
+    response = Response(prefix + encoded[1:], media_type="application/json")
+    if b'"pv":"ERROR:' not in encoded:
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = "max-age=86400"
+    return response
+
+
+async def _write_cache(redis, entries: dict[bytes, bytes]) -> None:
+    """SET every (already encoded) entry (24h TTL) in one pipelined round-trip."""
+    async with redis.pipeline(transaction=False) as pipe:
+        for entry_key, entry in entries.items():
+            pipe.set(entry_key, entry, ex=86_400)
+        await pipe.execute()
+
+
+def _on_cache_write_done(key: bytes, task: asyncio.Task) -> None:
+    _background_writes.discard(task)
+    if task.cancelled():
+        logger.warning("Cache write for key %s was cancelled.", key)
+    elif task.exception() is not None:
+        logger.error("Failed to set cache for key %s: %s", key, task.exception())
+    else:
+        logger.info("Successfully cached result for key: %s", key)
+
+
+async def _evaluate_and_cache(
+    key: bytes, position: str, fen: str, depth: int, board: chess.Board, time_ms: int | None, redis
+) -> bytes:
+    """
+    Run the engine for one cache miss, store the result and every shallower depth
+    the same search completed in L1, and write them all to Redis in the background.
+    Returns the encoded payload, the same bytes that were cached. Engine
+    errors are transient, so they are returned but never cached.
+    """
+    score, pv, by_depth = await evaluate_fen_by_depth(fen, depth, board, time_ms)
+    encoded = orjson.dumps({"score_cp": score, "pv": pv})
+    # Encoded once; L1, Redis and the response all use the same bytes.
+    entries = {} if pv.startswith("ERROR:") else {key: encoded}
+    entries.update(
+        (cache_key(position, d), orjson.dumps({"score_cp": d_score, "pv": d_pv}))
+        for d, (d_score, d_pv) in by_depth.items()
+        if not d_pv.startswith("ERROR:")
+    )
+    _L1.update(entries)
+
+    if redis is not None and entries:
+        # Don't hold the response for the Redis round-trip; failures are logged by the callback.
+        # The shallower depths from the same search ride along in the same pipeline.
+        task = asyncio.create_task(_write_cache(redis, entries))
+        _background_writes.add(task)
+        task.add_done_callback(partial(_on_cache_write_done, key))
+    return encoded
+
+
+async def _evaluate_single_flight(
+    key: bytes, position: str, fen: str, depth: int, board: chess.Board, time_ms: int | None, redis
+) -> bytes:
+    """
+    Run _evaluate_and_cache once per key across concurrent callers.
+    The work runs in its own task and every caller awaits it through
+    asyncio.shield(), so a caller that goes away (client disconnect) cancels
+    neither the search nor the other callers' wait, and the result still
+    gets cached.
+    """
+    # No await between the lookup and the insert, so this needs no lock.
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.create_task(_evaluate_and_cache(key, position, fen, depth, board, time_ms, redis))
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    else:
+        logger.info("Joining in-flight evaluation for key: %s.", key)
+    return await asyncio.shield(task)
 
 
 @app.get("/health")
@@ -78,48 +199,90 @@ async def health():
 async def eval_fen(
     fen: str = Query(..., description="Position in FEN notation"),
     depth: int = Query(20, ge=1, le=30), 
+    time_ms: int | None = Query(
+        None, ge=50, le=10_000, description="Optional search time budget; depth still caps the search"
+    ),
+    if_none_match: str | None = Header(None),
 ):
-    logger.info(f"Received /eval request for FEN: {fen}, Depth: {depth}")
+    logger.info("Received /eval request for FEN: %s, Depth: %d, Time budget (ms): %s", fen, depth, time_ms)
     
-    try:
-        chess.Board(fen)
-    except ValueError as exc:
-        logger.error(f"Invalid FEN received: {fen}. Error: {exc}")
-        raise HTTPException(status_code=400, detail=str(exc))
+    # Keyed on the normalized position; the raw FEN (with its halfmove clock) is still what gets analysed.
+    # The key comes from the string alone, so cache hits never build a chess.Board.
+    position = normalize_fen(fen)
+    if position is None:
+        # Raises the 400 with chess.Board's own error message. Syntax chess.Board
+        # tolerates but normalize_fen doesn't (e.g. "+0" counters) is keyed on the
+        # Board's own EPD, which normalize_fen otherwise reproduces exactly.
+        position = _parse_board(fen).epd(en_passant="xfen")
+    key = cache_key(position, depth, time_ms)
+    etag = etag_for(key)
+    if if_none_match == etag:
+        logger.info("ETag match for key: %s. Returning 304.", key)
+        return Response(status_code=304, headers={"ETag": etag})
+
+    local_result = _L1.get(key)
+    if local_result is not None:
+        logger.info("L1 cache hit for key: %s. Serving from process memory.", key)
+        return _eval_response(_CACHED, local_result, etag)
 
-    if app.state.redis is None:
+    redis = app.state.redis # Read once; app.state lookups go through State.__getattr__
+    if redis is None:
         logger.warning("Redis client (app.state.redis) is None! Proceeding without cache.")
-        score, pv = await evaluate_fen(fen, depth)
-        payload = {"score_cp": score, "pv": pv}
-        return {"cached": False, "error": "redis_unavailable", **payload}
-    else:
-        logger.info(f"Redis client available: {type(app.state.redis)}")
-        redis = app.state.redis
-        key = cache_key(fen, depth)
+        board = _parse_board(fen)
+        encoded = await _evaluate_single_flight(key, position, fen, depth, board, time_ms, None)
+        return _eval_response(_FRESH_NO_REDIS, encoded, etag)
 
-        # --- RE-ENABLE CACHE READ ---
-        try:
-            cached_result = await redis.get(key)
-            if cached_result:
-                logger.info(f"Cache hit for key: {key}. Serving from cache.")
-                data = json.loads(cached_result)
-                # IMPORTANT: Ensure the PV from cache is correctly handled by frontend
-                # If cached PV was an error string, frontend should display it as such.
-                return {"cached": True, **data}
-            logger.info(f"Cache miss for key: {key}. Evaluating with engine.")
-        except Exception as e_redis_get:
-            logger.error(f"Error reading from Redis cache for key {key}: {e_redis_get}. Proceeding with engine evaluation.")
-        # --- END CACHE READ RE-ENABLE ---
+    logger.info("Redis client available: %s", type(redis))
+    # --- RE-ENABLE CACHE READ ---
+    try:
+        # Refresh the TTL in the same round-trip so hot positions never expire
+        async with redis.pipeline(transaction=False) as pipe:
+            pipe.get(key)
+            pipe.expire(key, 86_400)
+            cached_result, _ = await pipe.execute()
+        if cached_result:
+            logger.info("Cache hit for key: %s. Serving from cache.", key)
+            _L1[key] = cached_result
+            # IMPORTANT: Ensure the PV from cache is correctly handled by frontend
+            # If cached PV was an error string, frontend should display it as such.
+            return _eval_response(_CACHED, cached_result, etag)
+        logger.info("Cache miss for key: %s. Evaluating with engine.", key)
+    except Exception as e_redis_get:
+        logger.error("Error reading from Redis cache for key %s: %s. Proceeding with engine evaluation.", key, e_redis_get)
+    # --- END CACHE READ RE-ENABLE ---
             
-    logger.info(f"Performing engine evaluation for FEN: {fen}, Depth: {depth}")
-    score, pv = await evaluate_fen(fen, depth) 
-    payload = {"score_cp": score, "pv": pv}
+    board = _parse_board(fen) # Parsed once here and reused by the engine
+    logger.info("Performing engine evaluation for FEN: %s, Depth: %d", fen, depth)
+    encoded = await _evaluate_single_flight(key, position, fen, depth, board, time_ms, redis)
+    return _eval_response(_FRESH, encoded, etag)
 
-    if app.state.redis is not None: # Check again, as it might have been None initially
-        try:
-            await redis.set(key, json.dumps(payload), ex=86_400) # Cache for 24 hours
-            logger.info(f"Successfully cached result for key: {key}")
-        except Exception as e_redis_set:
-            logger.error(f"Failed to set cache for key {key}: {e_redis_set}")
 
-    return {"cached": False, **payload}
+@app.get("/eval/stream")
+async def eval_fen_stream(
+    request: Request,
+    fen: str = Query(..., description="Position in FEN notation"),
+    depth: int = Query(20, ge=1, le=30), 
+    time_ms: int | None = Query(
+        None, ge=50, le=10_000, description="Optional search time budget; depth still caps the search"
+    ),
+):
+    """
+    NDJSON stream of {"depth", "score_cp", "pv"} lines, one per completed search
+    depth, so clients can show a first evaluation within milliseconds.
+    """
+    logger.info("Received /eval/stream request for FEN: %s, Depth: %d, Time budget (ms): %s", fen, depth, time_ms)
+    board = _parse_board(fen)
+
+    async def lines():
+        # aclosing() stops the engine search as soon as we stop reading from it
+        async with aclosing(stream_evaluation(fen, depth, board, time_ms)) as updates:
+            async for d, score, pv in updates:
+                if await request.is_disconnected():
+                    logger.info("Client disconnected from /eval/stream at depth %d; stopping search.", d)
+                    break
+                yield orjson.dumps({"depth": d, "score_cp": score, "pv": pv}) + b"\n"
+
+    # Identity encoding keeps GZipMiddleware from holding lines back in its compressor
+    return StreamingResponse(
+        lines(), media_type="application/x-ndjson", headers={"Content-Encoding": "identity"}
+    )
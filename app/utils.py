@@ -1,8 +1,106 @@
 import hashlib
+import re
 
-def cache_key(fen: str, depth: int) -> str:
+# Key suffixes for every depth /eval accepts (1-30), indexed by depth.
+_DEPTH_SUFFIXES = tuple(f"}}:{d}".encode() for d in range(31))
+
+def cache_key(fen: str, depth: int, time_ms: int | None = None) -> bytes:
+    """
+    Create the Redis key that uniquely identifies (fen, depth[, time_ms]).
+    The FEN goes in verbatim: it is under 90 ASCII bytes and Redis keys are
+    binary-safe, so hashing it would only cost CPU on every request.
+    It is wrapped in a Redis Cluster hash tag (sf:{fen}:depth), so every
+    depth of one position lands in the same slot and can be MGET together.
+    Encoded once here; redis-py sends bytes keys as-is on every command.
+    """
+    if time_ms is None and 0 <= depth < len(_DEPTH_SUFFIXES):
+        return b"sf:{" + fen.encode() + _DEPTH_SUFFIXES[depth]
+    limit = f"{depth}" if time_ms is None else f"{depth}:t{time_ms}"
+    return f"sf:{{{fen}}}:{limit}".encode()
+
+
+def etag_for(key: bytes) -> str:
+    """
+    Weak ETag for an /eval result: the body is determined by its cache key
+    (only the `cached` flag varies between responses).
+    """
+    return f'W/"{hashlib.blake2b(key, digest_size=8).hexdigest()}"'
+
+
+# FEN syntax chess.Board accepts: 8 ranks, then optional turn, castling,
+# en-passant and counter fields. Square counts are checked by chess.Board;
+# a promoted-piece marker ("~") is only accepted directly after a piece.
+_RANK = r"(?:[pnbrqkPNBRQK]~?|[1-8])+"
+_FEN_RE = re.compile(
+    rf"\s*{_RANK}(?:/{_RANK}){{7}}"
+    r"(?:\s+[wb](?:\s+(?:-|[KQkqA-Ha-h]+)(?:\s+(?:-|[a-h][1-8])(?:\s+\d+(?:\s+\d+)?)?)?)?)?\s*"
+)
+
+
+def normalize_fen(fen: str) -> str | None:
     """
-    Create a short Redis key that uniquely identifies (fen, depth).
+    Cache identity of a FEN, computed from the string alone so cache hits never
+    build a chess.Board: the counters are dropped, missing fields get the same
+    defaults chess.Board uses, castling rights are reduced to those the king
+    and rook placement still allow (in KQkq order), and the en-passant square
+    is kept only when a pawn stands ready to capture on it. Transpositions
+    therefore share one key.
+    Returns None when the string cannot be a FEN (a compiled-regex check, so
+    garbage is rejected before any cache lookup); it is not fully validated.
     """
-    digest = hashlib.sha256(f"{fen}-{depth}".encode()).hexdigest()[:32]
-    return f"sf:{depth}:{digest}"
+    if _FEN_RE.fullmatch(fen) is None:
+        return None
+    parts = fen.split()
+    # "~" marks the piece before it as promoted (crazyhouse). As in chess.Board's
+    # own FEN output it is not part of the key, but it still matters for castling.
+    placement = parts[0].replace("~", "")
+    turn = parts[1] if len(parts) > 1 else "w"
+    castling = parts[2] if len(parts) > 2 else "-"
+    ep = parts[3] if len(parts) > 3 else "-"
+    ranks = parts[0].split("/")
+    if castling != "-":
+        castling = _clean_castling(ranks, castling)
+    if ep != "-" and not _ep_capture_possible(ranks, turn, ep):
+        ep = "-"
+    return f"{placement} {turn} {castling} {ep}"
+
+
+def _expand_rank(row: str) -> str:
+    """
+    'r3k2r' -> 'r...k..r': one character per file, '.' for empty squares.
+    Promoted-piece markers ('~') take no square and are dropped.
+    """
+    return "".join("." * int(c) if c.isdigit() else c for c in row if c != "~")
+
+
+# Castling flag -> (rank index in the placement, king, king file, rook, rook file)
+_CASTLING_HOMES = {
+    "K": (7, "K", 4, "R", 7),
+    "Q": (7, "K", 4, "R", 0),
+    "k": (0, "k", 4, "r", 7),
+    "q": (0, "k", 4, "r", 0),
+}
+
+
+def _clean_castling(ranks: list[str], castling: str) -> str:
+    """Standard castling flags still backed by a king and rook on their home squares."""
+    if not set(castling) <= _CASTLING_HOMES.keys():
+        return castling # Chess960 file letters; keep verbatim
+    # A promoted king never backs castling rights (chess.Board.clean_castling_rights)
+    homes = {i: _expand_rank(ranks[i].replace("K~", "?").replace("k~", "?")) for i in (0, 7)}
+    kept = "".join(
+        flag for flag, (i, king, king_file, rook, rook_file) in _CASTLING_HOMES.items()
+        if flag in castling and homes[i][king_file:king_file + 1] == king and homes[i][rook_file:rook_file + 1] == rook
+    )
+    return kept or "-"
+
+
+def _ep_capture_possible(ranks: list[str], turn: str, ep: str) -> bool:
+    """Whether a pawn of the side to move sits beside the pawn that just double-pushed past `ep`."""
+    if len(ep) != 2 or ep[0] not in "abcdefgh":
+        return True # Malformed; leave it for chess.Board to reject
+    # White captures from rank 5 (ranks[3]), Black from rank 4 (ranks[4])
+    row, pawn = (ranks[3], "P") if turn == "w" else (ranks[4], "p")
+    squares = _expand_rank(row)
+    file = ord(ep[0]) - ord("a")
+    return any(0 <= f < len(squares) and squares[f] == pawn for f in (file - 1, file + 1))